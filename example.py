@@ -36,7 +36,7 @@ def main():
     schema.addView(categoriesView, bookCategory)
     schema.addView(citiesView, publisherCity)
     
-    schema.attrByName('Categories.category_name').userName = 'Category name'
+    schema.setUserName('Categories.category_name', 'Category name')
     
     subBuilder = QueryBuilder(schema)
     authorAttr = booksView['author'].select(aggregate=lambda a: 'count('+a+')', altName='Authors', orderBy=True, condition=andCondition('LIKE'))
@@ -16,30 +16,58 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import collections
+import contextlib
+import itertools
+import math
+import re
 import string
 from views import *   
 
 class AliasGen(object):
 
     def __init__(self):
-        self._start = 1
+        self._counter = itertools.count(1)
         self._letters = string.uppercase
         self._len = len(self._letters)
         
     def next(self):
-        tmp = self._start
+        tmp = self._counter.next()
         base = []
         while tmp > 0:
             idx = tmp % self._len
             base.insert(0, self._letters[idx-1])
             tmp = tmp / self._len
-        self._start += 1
         return ''.join(base)
 
 ALIAS_GEN = AliasGen()
 
 Alias = collections.namedtuple('Alias', ['view', 'alias'])
 Query = collections.namedtuple('Query', ['statement', 'params', 'attributes'])           
+
+class Preview(collections.namedtuple('Preview', ['statement', 'params', 'attributes', 'fraction', 'errorSources'])):
+    '''
+        Query prepared for execution on sample of rows (see: Sample).
+        Besides fields of Query, it contains sampled fraction of rows
+        and, for each selected attribute, index of column used to estimate
+        standard error of attribute (or None, if error is not estimated).
+    '''
+    
+    def estimates(self, row):
+        '''
+            Converts row returned by previewed query into list of pairs
+            (value, standard error) for each selected attribute.
+            Errors are rough estimates, which assume that each row was
+            sampled independently.
+        '''
+        result = []
+        p = self.fraction
+        for i, src in enumerate(self.errorSources):
+            if src is None or row[src] is None:
+                result.append((row[i], None))
+            else:
+                result.append((row[i], math.sqrt(max(row[src], 0) * (1 - p) / p)))
+        return result
+        
         
 class Node(object):
     '''
@@ -69,13 +97,30 @@ class Node(object):
         self.children.append(nn)
         return nn
     
-    def toString(self, parentAlias=None):
-        s = self.av.view.source+' '+self.av.alias
+    def toString(self, parentAlias=None, names=None):
+        '''
+            Creates string of this node and its children. If names
+            are passed, views found in names are referenced by mapped
+            name instead of their source.
+        '''
+        if names and self.av.view in names:
+            s = names[self.av.view]+' '+self.av.alias
+        else:
+            s = self.av.view.source+' '+self.av.alias
         if self.relation:
             s += ' on ' + self.relation.toString(parentAlias, self.av)
         for ch in self.children:
-            s += '\n '+ch.joinStr+' '+ ch.toString(self.av)
+            s += '\n '+ch.joinStr+' '+ ch.toString(self.av, names)
         return s
+        
+    def views(self):
+        '''
+            Lists views of this node and its children in join order.
+        '''
+        vs = [self.av.view]
+        for ch in self.children:
+            vs.extend(ch.views())
+        return vs
             
 class Tree(object):
     '''
@@ -89,6 +134,7 @@ class Tree(object):
         self.viewNode = {}
         self.idx = 0
         self.schema = schema
+        self.filters = []
     
     def addJoin(self, view, outerJoin=False):
         '''
@@ -112,11 +158,30 @@ class Tree(object):
                 raise Exception('No related view in tree')
         self.idx += 1
         
-    def createString(self):
+    def addFilter(self, attr, valueFilter):
+        '''
+            Joins temporary table of value filter with view of
+            attribute. View has to be already added to tree.
+            Filter used by many attributes is staged once.
+        '''
+        node = self.viewNode[attr.view]
+        node.addJoin(Alias(valueFilter.view, ALIAS_GEN.next()), valueFilter.relation(attr))
+        if valueFilter not in self.filters:
+            self.filters.append(valueFilter)
+        
+    def createString(self, names=None):
         '''
             Uses tree to create full 'FROM' clause.
         '''
-        return self.root.toString()
+        return self.root.toString(names=names)
+        
+    def views(self):
+        '''
+            Lists all views in tree in join order.
+        '''
+        if not self.root:
+            return []
+        return self.root.views()
         
     def getAlias(self, view):
         '''
@@ -135,19 +200,49 @@ class QueryView(IView):
         self.tree = tree
         self.attrs = attrs
         
-    def _build(self, addWhere=True):
+    def _build(self, addWhere=True, commonViews=False, sample=None):
+        '''
+        Builds query string. If commonViews is true, each query view
+        used in this query, directly or through other query views, is
+        emitted once in WITH clause and referenced by its name.
+        If sample is passed, sampled views are read from sample of rows.
+        '''
+        names = {}
+        withList = []
+        if commonViews:
+            for i, v in enumerate(self.subqueries()):
+                name = 'pyqube_view_%d' % (i+1)
+                withList.append(name+' AS ('+v._select(False, names)+')')
+                names[v] = name
+        if sample:
+            for v in sample.views(self.tree):
+                names[v] = sample.source(v)
+        query = self._select(addWhere, names, sample)
+        if withList:
+            query = 'WITH '+',\n '.join(withList)+'\n '+query
+        return query
+        
+    def _select(self, addWhere=True, names=None, sample=None):
         query = 'SELECT '
         attrList = []
+        errorList = []
         orderList = []
         groupList = []
         whereList = []
         cc = 0
+        if sample:
+            factor = sample.factor(self.tree)
         for a in self.attrs:        
             alias = self.tree.getAlias(a.view)
             qn = a.queryName(alias)
-            an = a.toString(alias)
+            if sample:
+                an = sample.attrString(a, alias, factor)
+            else:
+                an = a.toString(alias)
             if a.visible:
                 attrList.append(an)
+                if sample and sample.errorString(a, alias, factor):
+                    errorList.append(sample.errorString(a, alias, factor))
             if a.orderBy:
                 orderList.append(qn)
             if a.groupBy:
@@ -156,8 +251,8 @@ class QueryView(IView):
                 cstr = a.condition.toString(a.condName(alias), cc)
                 whereList.append(cstr[0])
                 cc = cstr[1]
-        query += ', '.join(attrList)
-        query += '\n FROM '+self.tree.createString()
+        query += ', '.join(attrList + errorList)
+        query += '\n FROM '+self.tree.createString(names)
         if whereList:
             query += '\n WHERE '+ ' '.join(whereList)
         if groupList:
@@ -175,14 +270,35 @@ class QueryView(IView):
         vs = '('+self._build(False)+')'
         return vs
         
-    def prepare(self):
+    def subqueries(self, found=None):
+        '''
+        Finds all distinct query views used by this query, directly
+        or through other query views. Each view is placed after
+        views it depends on.
+        '''
+        if found is None:
+            found = []
+        for v in self.tree.views():
+            if isinstance(v, QueryView) and v not in found:
+                v.subqueries(found)
+                found.append(v)
+        return found
+        
+    def prepare(self, commonViews=False, sample=None):
         '''
         Prepares query for execution. All query parameters have
         assigned placeholders, which might be used to set values.
         Method returns tuple (query string, map of placeholders 
         and names of attributes, selected attributes)
+        params:
+            - commonViews: if true, subqueries are emitted once in WITH clause
+            - sample: optional sample (see: Sample). If it is passed, query
+            is previewed on sample of rows and Preview is returned.
+        If query (or its subquery) uses value filters, returned statement
+        references theirs temporary tables, which exist only inside
+        QueryView.staged block. Use staged to execute such query.
         '''
-        vs = self._build(True)
+        vs = self._build(True, commonViews, sample)
         params = {}
         cc = 0
         for a in self.attrs:
@@ -191,26 +307,248 @@ class QueryView(IView):
                 for n in names[0]:
                     params[n] = a
                 cc = names[1]
-        return Query(vs, params, [a for a in self.attrs if a.visible])
+        attributes = [a for a in self.attrs if a.visible]
+        if sample:
+            return Preview(vs, params, attributes, 1.0 / sample.factor(self.tree), 
+                           sample.errorSources(attributes))
+        return Query(vs, params, attributes)
+        
+    def valueFilters(self):
+        '''
+        Finds all value filters used by this query and by queries
+        used as its subqueries.
+        '''
+        filters = list(self.tree.filters)
+        for v in self.tree.views():
+            if isinstance(v, QueryView):
+                for f in v.valueFilters():
+                    if f not in filters:
+                        filters.append(f)
+        return filters
+        
+    @contextlib.contextmanager
+    def staged(self, connection, commonViews=False, sample=None):
+        '''
+        Prepares query and creates temporary tables of value filters
+        on passed connection. Tables are removed when block is left.
+        Parameters commonViews and sample are passed to prepare.
+        Note: sqlite3 module of Python 2 commits open transaction before
+        CREATE and DROP statements, so changes made on connection before
+        block is entered (or inside block) can not be rolled back afterwards.
+        Commit or roll back pending changes before query is staged.
+        Usage:
+            with view.staged(connection) as query:
+                connection.execute(query.statement, values)
+        '''
+        filters = self.valueFilters()
+        cursor = connection.cursor()
+        created = []
+        try:
+            for f in filters:
+                f.create(cursor)
+                created.append(f)
+            yield self.prepare(commonViews, sample)
+        finally:
+            for f in created:
+                f.drop(cursor)
+            cursor.close()
+        
+    def _realName(self, attr):
+        '''
+        Name of selected attribute. User name is taken from
+        version of schema used by query.
+        '''
+        if attr.altName:
+            return attr.altName
+        return self.tree.schema.userName(attr) or attr.name
         
     def attribute(self, name):
         for a in self.attrs:
-            if a.visible and a.realName() == name:
-                return ViewAttr(a.realName(), self)
+            if a.visible and self._realName(a) == name:
+                return ViewAttr(name, self)
         else:
             raise Exception('Attribute '+name+' not found')
             
     def viewAttrs(self):
         return [a for a in self.attrs if a.visible]
         
+class Sample(object):
+    '''
+        Deterministic sample of rows used to preview query. Root view
+        of query (and optionally views joined with it) is read only from
+        about one of each modulus rows. Results of count and sum aggregates 
+        are scaled by inverse of sampled fraction.
+        By default rows, which rowid is multiple of modulus, are read. 
+        Such condition can not use index, so every row of table is still
+        scanned. It is also not random: if rows were inserted in periodic 
+        pattern, which period shares divisor with modulus (for example, 
+        foreign key cycling through ten values and modulus 10), sample 
+        contains only some of values. Groups are then missing and 
+        estimates are biased. Choose modulus, which is prime and not related
+        to insertion pattern.
+        If blocks are passed, range of rowids (from min to max) is divided
+        into blocks and only beginning of each block is read, with rowid
+        BETWEEN-like ranges searched in primary key. Such sample does not
+        scan table, but rows of each block are neighbours, so rows clustered
+        by insertion order bias estimates and fraction is exact only for
+        dense rowids. Standard errors are computed as if rows were 
+        sampled independently, so in both modes they are only rough.
+        Only tables might be sampled by rowid. Views defined by query
+        might be sampled if their integer column is named.
+    '''
+    
+    def __init__(self, modulus, joined=False, column='rowid', blocks=None):
+        '''
+            Initialise sample.
+            params:
+                - modulus: one of each modulus rows is read
+                - joined: if true, table views joined (not outer joined) with
+                root view are also sampled
+                - column: integer column used to choose rows
+                - blocks: optional number of rowid ranges read from each view
+            If modulus or blocks is not positive integer, an exception is raised.
+        '''
+        if int(modulus) != modulus or modulus < 1:
+            raise Exception('Modulus has to be positive integer')
+        if blocks is not None and (int(blocks) != blocks or blocks < 1):
+            raise Exception('Number of blocks has to be positive integer')
+        self.modulus = int(modulus)
+        self.joined = joined
+        self.column = column
+        self.blocks = blocks
+        
+    def _sampled(self, view):
+        '''
+            Checks if view might be sampled. Views defined by query have
+            no rowid, so they are sampled only by named column.
+        '''
+        if isinstance(view, QueryView):
+            return False
+        return self.column != 'rowid' or re.match(r'^[\w.]+$', view.source) is not None
+        
+    def views(self, tree):
+        '''
+            Finds views of tree, which are sampled. Root of tree has
+            to be table view.
+        '''
+        root = tree.root.av.view
+        if not self._sampled(root):
+            raise Exception('Only table views might be sampled')
+        vs = [root]
+        if self.joined:
+            skip = [f.view for f in tree.filters]
+            nodes = list(tree.root.children)
+            while nodes:
+                n = nodes.pop(0)
+                if n.joinStr != 'JOIN':
+                    continue
+                if self._sampled(n.av.view) and n.av.view not in skip:
+                    vs.append(n.av.view)
+                nodes.extend(n.children)
+        return vs
+        
+    def factor(self, tree):
+        '''
+            Inverse of fraction of rows selected from tree.
+        '''
+        return self.modulus ** len(self.views(tree))
+        
+    def source(self, view):
+        '''
+            Creates source of sampled view.
+        '''
+        src = view.source
+        if not self.blocks:
+            return '(SELECT * FROM %s WHERE %s %% %d = 0)' % (src, self.column, self.modulus)
+        # separate min and max subqueries are answered from primary key
+        low = '(SELECT min(%s) FROM %s)' % (self.column, src)
+        high = '(SELECT max(%s) FROM %s)' % (self.column, src)
+        stride = 'max(1, (%s - %s + 1) / %d)' % (high, low, self.blocks)
+        length = 'max(1, %s / %d)' % (stride, self.modulus)
+        blockList = []
+        for i in range(self.blocks):
+            start = '%s + %d * %s' % (low, i, stride)
+            blockList.append('SELECT * FROM %s WHERE %s >= %s AND %s < %s + %s' % 
+                             (src, self.column, start, self.column, start, length))
+        return '('+'\n UNION ALL '.join(blockList)+')'
+        
+    def _kind(self, attr):
+        '''
+            Finds how aggregate of attribute is scaled: 'count', 'sum' or
+            None (not scaled). Kind passed as scale of attribute (see: 
+            ViewAttr.select) is used first. Otherwise it is guessed from 
+            aggregate: without white spaces and in lower case, it has to
+            start with 'count(' or 'sum(' ('total(' is also sum). Distinct 
+            counts and any other expression are not scaled.
+        '''
+        if not attr.aggregate:
+            return None
+        if attr.scale:
+            if attr.scale not in ('count', 'sum'):
+                raise Exception('Unknown scale '+attr.scale)
+            return attr.scale
+        agg = re.sub(r'\s', '', attr.aggregate('x')).lower()
+        if 'distinct' in agg:
+            return None
+        elif agg.startswith('count('):
+            return 'count'
+        elif agg.startswith('sum(') or agg.startswith('total('):
+            return 'sum'
+        return None
+        
+    def attrString(self, attr, alias, factor):
+        '''
+            Creates string of selected attribute. Count and sum
+            aggregates are scaled by factor.
+        '''
+        if not self._kind(attr):
+            return attr.toString(alias)
+        base = '(%s * %d)' % (attr.aggregate(attr.condName(alias)), factor)
+        if attr.altName:
+            base += ' as '+attr.altName
+        return base
+        
+    def errorString(self, attr, alias, factor):
+        '''
+            Creates string of additional column used to estimate error
+            of sum aggregate. For other attributes None is returned.
+        '''
+        if self._kind(attr) != 'sum':
+            return None
+        name = attr.condName(alias)
+        return '(sum(%s * %s) * %d)' % (name, name, factor)
+        
+    def errorSources(self, attrs):
+        '''
+            Finds index of column used to estimate error for each of
+            selected attributes.
+        '''
+        sources = []
+        extra = len(attrs)
+        for i, a in enumerate(attrs):
+            kind = self._kind(a)
+            if kind == 'count':
+                sources.append(i)
+            elif kind == 'sum':
+                sources.append(extra)
+                extra += 1
+            else:
+                sources.append(None)
+        return sources
+        
 class QueryBuilder(object):
     '''
         Uses selected view attributes to build SELECT query.
     '''
     
     def __init__(self, schema):
+        '''
+            Initialise builder. Builder uses version of schema
+            current at the time it is created.
+        '''
         self.attrs = []
-        self.tree = Tree(schema)
+        self.schema = schema.snapshot()
+        self.tree = Tree(self.schema)
         
     def add(self, selectAttr, outerJoin=False):
         '''
@@ -218,6 +556,8 @@ class QueryBuilder(object):
             JOINs between views.
         '''
         self.tree.addJoin(selectAttr.view, outerJoin)
+        if selectAttr.valueFilter:
+            self.tree.addFilter(selectAttr, selectAttr.valueFilter)
         self.attrs.append(selectAttr)
         
     def _validate(self):
@@ -233,11 +573,11 @@ class QueryBuilder(object):
         else:
             raise Exception('aggregate and group by')
             
-    def build(self):
+    def build(self, commonViews=False, sample=None):
         '''
             Builds query string
         '''
-        return self.createQuery().prepare()
+        return self.createQuery().prepare(commonViews, sample)
         
     def createQuery(self, name='Query'):
         self._validate()
@@ -15,14 +15,134 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import copy
+import itertools
+import threading
+
+class FrozenDict(dict):
+    '''
+        Dictionary, which can not be modified after it is created.
+    '''
+    def _readOnly(self, *args, **kwargs):
+        raise TypeError('FrozenDict is read only')
+        
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _readOnly
+    
+    def __copy__(self):
+        return FrozenDict(self)
+        
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+class SchemaSnapshot(object):
+    '''
+        Immutable version of schema. Snapshot is never modified after it
+        is published, so it might be read by many threads without locking.
+        Indexes of views and attributes are computed once, when snapshot
+        is created. Attributes returned by snapshot are its own read-only
+        copies, which have user names of this version.
+    '''
+    def __init__(self, version, views, rels, userNames):
+        '''
+            Initialise snapshot.
+            params:
+                - version: number of schema version
+                - views: map of views and tuples of related views
+                - rels: map of pairs of views and theirs relations
+                - userNames: map of pairs (view, attribute name) and user names
+        '''
+        self.version = version
+        self.views = FrozenDict(views)
+        self.rels = FrozenDict(rels)
+        self.userNames = FrozenDict(userNames)
+        self._viewNames = {}
+        self._attrNames = {}
+        attrs = []
+        for v in views.iterkeys():
+            self._viewNames.setdefault(v.name, v)
+            for a in v.viewAttrs():
+                a = copy.copy(a)
+                a.userName = self.userName(a)
+                a.freeze()
+                self._attrNames.setdefault(a.fullName(), a)
+                attrs.append(a)
+        attrs.sort(key=lambda a: a.fullName())
+        self._attributes = tuple(attrs)
+        
+    def snapshot(self):
+        return self
+        
+    def relatedViews(self, view):
+        '''
+            Finds all views, which have relation with passed one.
+            Views are returned as tuple.
+        '''
+        return self.views[view]
+        
+    def userName(self, attr):
+        '''
+            Finds user name of attribute in this version of schema.
+        '''
+        return self.userNames.get((attr.view, attr.name), attr.userName)
+        
+    def viewByName(self, name):
+        return self._viewNames.get(name)
+        
+    def attrByName(self, fullName):
+        return self._attrNames.get(fullName)
+        
+    def relation(self, view, related):
+        '''
+            Finds object representing relation between two views.
+            If such relation is not fount, method returns None.
+            params:
+                - view: table or query
+                - related: table or query, which is related to view
+        '''
+        if self.rels.has_key((view, related)):
+            return self.rels[(view, related)]
+        elif self.rels.has_key((related, view)):
+            return self.rels[(related, view)]
+        return None
+        
+    def attributes(self):
+        return list(self._attributes)
+        
 class Schema(object):
     '''
         Database schema, which includes views (tables and predefined queries)
         and theirs relations.
+        Schema might be shared by many threads. Readers use current snapshot
+        (see: SchemaSnapshot) without locking. Each change creates new 
+        snapshot, which replaces current one.
+        Maps views and rels are read-only and related views are stored
+        as tuples (not lists). Attributes returned by schema are read-only,
+        so user name can not be assigned directly. Use setUserName instead.
     '''
     def __init__(self):
-        self.views = {} 
-        self.rels = {}
+        self._lock = threading.Lock()
+        self._snapshot = SchemaSnapshot(0, {}, {}, {})
+        
+    @property
+    def views(self):
+        return self._snapshot.views
+        
+    @property
+    def rels(self):
+        return self._snapshot.rels
+        
+    @property
+    def version(self):
+        return self._snapshot.version
+        
+    def snapshot(self):
+        '''
+            Returns current version of schema.
+        '''
+        return self._snapshot
+        
+    def _publish(self, views, rels, userNames):
+        self._snapshot = SchemaSnapshot(self._snapshot.version + 1, views, rels, userNames)
         
     def addView(self, view, relation=None):
         '''
@@ -33,38 +153,52 @@ class Schema(object):
                 other view already existing in schema. If relation
                 is passed and related view does not exist, an exception is raised.
         '''
-        if not relation:
-            self.views[view] = []
-        else:
-            rv = relation.related(view).view
-            if self.views.has_key(rv):
-                self.views[view] = [rv]
-                self.views[rv].append(view)
-                self.rels[(view, rv)] = relation
-                self.rels[(rv, view)] = relation
+        with self._lock:
+            views = dict(self._snapshot.views)
+            rels = self._snapshot.rels
+            if not relation:
+                views[view] = ()
             else:
-                raise Exception('no related views')
+                rv = relation.related(view).view
+                if views.has_key(rv):
+                    views[view] = (rv,)
+                    views[rv] = views[rv] + (view,)
+                    rels = dict(rels)
+                    rels[(view, rv)] = relation
+                    rels[(rv, view)] = relation
+                else:
+                    raise Exception('no related views')
+            self._publish(views, rels, self._snapshot.userNames)
+            
+    def setUserName(self, fullName, userName):
+        '''
+            Changes user name of attribute and publishes new version
+            of schema. Attributes of previous versions are not changed.
+            If attribute is not found, an exception is raised.
+        '''
+        with self._lock:
+            attr = self._snapshot.attrByName(fullName)
+            if not attr:
+                raise Exception('Attribute '+fullName+' not found')
+            userNames = dict(self._snapshot.userNames)
+            userNames[(attr.view, attr.name)] = userName
+            self._publish(self._snapshot.views, self._snapshot.rels, userNames)
                 
     def relatedViews(self, view):
         '''
             Finds all views, which have relation with passed one.
+            Views are returned as tuple.
         '''
-        return self.views[view]
+        return self._snapshot.relatedViews(view)
+        
+    def userName(self, attr):
+        return self._snapshot.userName(attr)
         
     def viewByName(self, name):
-        for v in self.views.iterkeys():
-            if v.name == name:
-                return v
-        return None
+        return self._snapshot.viewByName(name)
         
     def attrByName(self, fullName):
-        pair = fullName.split('.')
-        view = self.viewByName(pair[0])
-        if view:
-            for attr in view.viewAttrs():
-                if attr.realName() == pair[1]:
-                    return attr
-        return None
+        return self._snapshot.attrByName(fullName)
         
     def relation(self, view, related):
         '''
@@ -74,18 +208,10 @@ class Schema(object):
                 - view: table or query
                 - related: table or query, which is related to view
         '''
-        if self.rels.has_key((view, related)):
-            return self.rels[(view, related)]
-        elif self.rels.has_key((related, view)):
-            return self.rels[(related, view)]
-        return None
+        return self._snapshot.relation(view, related)
         
     def attributes(self):
-        attrs = []
-        for v in self.views.iterkeys():
-            attrs.extend(v.viewAttrs())
-        attrs.sort(cmp=lambda x,y: cmp(x.view.name+'.'+x.realName(), y.view.name+'.'+y.realName()))
-        return attrs
+        return self._snapshot.attributes()
         
 class ViewAttr(object):
     '''
@@ -97,7 +223,19 @@ class ViewAttr(object):
         self.view = view 
         self.userName = userName
         
-    def select(self, visible=True, orderBy=False, groupBy=False, condition=None, aggregate=None, altName=None):
+    def __setattr__(self, name, value):
+        if self.__dict__.get('_frozen'):
+            raise Exception('Attribute of schema snapshot is read only (see: Schema.setUserName)')
+        object.__setattr__(self, name, value)
+        
+    def freeze(self):
+        '''
+            Makes attribute read-only. Attributes of schema snapshot
+            are frozen.
+        '''
+        self._frozen = True
+        
+    def select(self, visible=True, orderBy=False, groupBy=False, condition=None, aggregate=None, altName=None, valueFilter=None, scale=None):
         '''
             Uses parameters and creates attribute used in SELECT clause
             parmas:
@@ -107,6 +245,8 @@ class ViewAttr(object):
                 - condition: function used to create conditonal expression in query
                 - aggregate: aggregation function
                 - altName: alternative (alias) name for attribute
+                - valueFilter: list of allowed values staged in temporary table (see: ValueListFilter)
+                - scale: 'count' or 'sum' - how aggregate is scaled in sampled preview (see: Sample)
         '''
         sa = SelectAttr(self.name, self.view, self.userName)
         sa.visible = visible
@@ -115,6 +255,8 @@ class ViewAttr(object):
         sa.condition = condition
         sa.aggregate = aggregate
         sa.altName = altName
+        sa.valueFilter = valueFilter
+        sa.scale = scale
         return sa
     
     def _prepareStr(self, alias):
@@ -145,6 +287,8 @@ class SelectAttr(ViewAttr):
         self.condition = None
         self.aggregate=None
         self.altName = None
+        self.valueFilter = None
+        self.scale = None
     
     def _prepareStr(self, alias):
         base = ViewAttr._prepareStr(self, alias)
@@ -317,6 +461,59 @@ class ConditionChain(object):
     def build(self):
         return self.cond
         
+TEMP_TABLE_IDS = itertools.count(1)
+
+class ValueListFilter(object):
+    '''
+        Filter, which restricts attribute to list of values. Instead of
+        one placeholder per value, values are loaded into indexed temporary
+        table, which is joined with view of attribute. Table has to be created
+        on executing connection before query is executed (see: QueryView.staged).
+        Statement prepared outside of staged block references table, which
+        does not exist.
+        Unlike conditions, filter is part of FROM clause, so it is applied
+        also when query is used as subquery (see: QueryView.source).
+    '''
+    def __init__(self, values, tableName=None):
+        '''
+            Initialise filter.
+            params:
+                - values: iterable of allowed values. Duplicates are ignored.
+                Values are copied, so filter might be staged many times.
+                - tableName: optional name of temporary table. If it is not passed,
+                unique name is generated.
+        '''
+        self.values = tuple(values)
+        if not tableName:
+            tableName = 'pyqube_values_%d' % TEMP_TABLE_IDS.next()
+        self.tableName = tableName
+        self.view = View(tableName, tableName, ['value'])
+        
+    def create(self, cursor):
+        '''
+            Creates temporary table and loads values into it.
+            If values can not be loaded, table is removed.
+        '''
+        cursor.execute('CREATE TEMPORARY TABLE %s (value PRIMARY KEY)' % self.tableName)
+        try:
+            cursor.executemany('INSERT OR IGNORE INTO %s (value) VALUES (:value)' % self.tableName,
+                               ({'value': v} for v in self.values))
+        except:
+            self.drop(cursor)
+            raise
+        
+    def drop(self, cursor):
+        '''
+            Removes temporary table.
+        '''
+        cursor.execute('DROP TABLE IF EXISTS %s' % self.tableName)
+        
+    def relation(self, attr):
+        '''
+            Creates relation between attribute and temporary table.
+        '''
+        return Relation([AttrPair(attr, self.view['value'])])
+        
 class Relation(object):
     '''
         Representation of relation between two views. Each relations contains